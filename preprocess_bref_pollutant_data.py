@@ -2,8 +2,269 @@
 # preprocess_bref_pollutant_data.py
 import pandas as pd
 import json
+import logging
 import os
-import copy
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib json module
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Re-walk every pollutant-specific hierarchy to check that the match flags are consistent
+DEBUG_VALIDATE = False
+
+# Hierarchy and match masks of the current worker process, set up once by init_worker
+_worker_state = {}
+
+def load_json(path):
+    """Load a JSON file, using orjson when it is installed."""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_json(obj, path, default=None):
+    """
+    Save an object as compact JSON, using orjson when it is installed.
+    `default` converts values JSON does not support, e.g. `list` for sets.
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, default=default))
+        return
+    
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, default=default)
+
+def iter_children(node):
+    """Iterate over a node's children, whether they are stored in a list or a dict."""
+    children = node.get('children')
+    if isinstance(children, dict):
+        return children.values()
+    if isinstance(children, list):
+        return children
+    return ()
+
+def compute_match_masks(bref_hierarchy, node_id_to_bitmask):
+    """
+    Walk the hierarchy once, post-order, computing the match masks of every node.
+    
+    Returns a dict mapping id(node) to the (direct matches, matches among descendants)
+    masks of each node.
+    """
+    node_masks = {}
+    
+    # Phase 1: collect every node with an explicit stack, parents before their children
+    nodes = []
+    stack = []
+    for bref_content in bref_hierarchy.values():
+        if isinstance(bref_content, dict):
+            stack.append(bref_content)
+        elif isinstance(bref_content, list):
+            stack.extend(bref_content)
+    
+    while stack:
+        node = stack.pop()
+        
+        # Skip non-node items
+        if not node or not isinstance(node, dict):
+            continue
+        
+        nodes.append(node)
+        stack.extend(iter_children(node))
+    
+    # Phase 2: visit children before their parents, combining the masks of all children nodes
+    for node in reversed(nodes):
+        node_id = node.get('id')
+        match_mask = node_id_to_bitmask.get(node_id, 0) if node_id else 0
+        child_mask = 0
+        for child in iter_children(node):
+            child_masks = node_masks.get(id(child))
+            if child_masks:
+                child_mask |= child_masks[0] | child_masks[1]
+        
+        node_masks[id(node)] = (match_mask, child_mask)
+    
+    return node_masks
+
+def update_hierarchy_with_matches(root, bit, node_masks, stats, path=""):
+    """
+    Copy the hierarchy with an explicit stack, marking nodes with matches for the pollutant bit.
+    Flags are only written when True; readers treat a missing flag as False.
+    """
+    # Non-node items are kept as they are
+    if not root or not isinstance(root, dict):
+        return root
+    
+    # The flags come straight from the precomputed masks, so parents can be
+    # copied before their children. Each stack entry records where the copy goes.
+    result = [root]
+    stack = [(root, path, result, 0)]
+    while stack:
+        node, parent_path, container, key = stack.pop()
+        node_id = node.get('id')
+        current_path = f"{parent_path}/{node_id}" if node_id else parent_path
+        match_mask, child_mask = node_masks[id(node)]
+        
+        # Nothing in this subtree matches the pollutant, so it has no flags to add:
+        # share the original subtree instead of copying it
+        if not (match_mask | child_mask) & bit:
+            container[key] = node
+            continue
+        
+        # Copy the node so the shared hierarchy is never modified
+        pollutant_node = dict(node)
+        container[key] = pollutant_node
+        
+        # IMPORTANT: Set the flags directly on the node without any nesting
+        if match_mask & bit:
+            pollutant_node['hasMatchForPollutant'] = True
+            stats['matches'] += 1
+            logger.debug("MATCH: %s", current_path)
+        
+        # Process children nodes, stored as a list or a dict; non-node children are kept as they are
+        children = node.get('children')
+        if isinstance(children, (list, dict)):
+            pollutant_children = children.copy()
+            pollutant_node['children'] = pollutant_children
+            child_keys = pollutant_children.keys() if isinstance(children, dict) else range(len(children))
+            for child_key in child_keys:
+                child = pollutant_children[child_key]
+                if child and isinstance(child, dict):
+                    stack.append((child, current_path, pollutant_children, child_key))
+        
+        # Mark node if any children have matches
+        if child_mask & bit:
+            pollutant_node['hasChildrenWithMatchForPollutant'] = True
+            if not match_mask & bit:
+                stats['parents'] += 1
+                logger.debug("PARENT WITH MATCHING CHILDREN: %s", current_path)
+    
+    return result[0]
+
+def validate_hierarchy_matches(root, path=""):
+    """Validate that each node's children flag agrees with the flags of its children."""
+    valid = True
+    stack = [(root, path)]
+    while stack:
+        node, path = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        
+        node_path = f"{path}/{node.get('id', 'root')}"
+        children = iter_children(node)
+        
+        # Missing flags mean False, so a node is only marked when one of its children is
+        children_match = any(
+            isinstance(child, dict) and (
+                child.get('hasMatchForPollutant', False)
+                or child.get('hasChildrenWithMatchForPollutant', False)
+            )
+            for child in children
+        )
+        if node.get('hasChildrenWithMatchForPollutant', False) != children_match:
+            logger.warning("Inconsistent match flags in node %s", node_path)
+            valid = False
+        
+        # Validate children
+        stack.extend((child, node_path) for child in children)
+    
+    return valid
+
+def init_worker(serialized_hierarchy, node_id_to_bitmask):
+    """Parse the BREF hierarchy and compute its match masks once per worker process."""
+    if orjson is not None:
+        bref_hierarchy = orjson.loads(serialized_hierarchy)
+    else:
+        bref_hierarchy = json.loads(serialized_hierarchy)
+    
+    node_masks = compute_match_masks(bref_hierarchy, node_id_to_bitmask)
+    _worker_state['hierarchy'] = bref_hierarchy
+    _worker_state['node_masks'] = node_masks
+
+def process_one(pollutant, bit, output_path):
+    """
+    Build and save the BREF hierarchy with match information for a single pollutant.
+    Runs in a worker process set up by init_worker and returns a summary of the matches.
+    """
+    bref_hierarchy = _worker_state['hierarchy']
+    node_masks = _worker_state['node_masks']
+    
+    # Project the precomputed masks onto a copy of the hierarchy for this pollutant
+    stats = {'matches': 0, 'parents': 0}
+    pollutant_hierarchy = {}
+    top_level_match_count = 0
+    for bref_type, bref_content in bref_hierarchy.items():
+        if isinstance(bref_content, dict):
+            pollutant_content = update_hierarchy_with_matches(
+                bref_content, bit, node_masks, stats, bref_type
+            )
+            has_match = pollutant_content.get('hasMatchForPollutant', False) or pollutant_content.get('hasChildrenWithMatchForPollutant', False)
+            
+            # Log the flags set on the top-level document
+            logger.debug(
+                "BREF document '%s' for pollutant '%s': direct match %s, children with matches %s",
+                bref_type,
+                pollutant,
+                pollutant_content.get('hasMatchForPollutant', False),
+                pollutant_content.get('hasChildrenWithMatchForPollutant', False),
+            )
+            
+            if has_match:
+                top_level_match_count += 1
+        
+        elif isinstance(bref_content, list):
+            pollutant_content = []
+            has_matches = False
+            for item in bref_content:
+                pollutant_item = update_hierarchy_with_matches(
+                    item, bit, node_masks, stats, bref_type
+                )
+                pollutant_content.append(pollutant_item)
+                
+                # Check if any matches were found
+                if isinstance(pollutant_item, dict) and (
+                    pollutant_item.get('hasMatchForPollutant', False)
+                    or pollutant_item.get('hasChildrenWithMatchForPollutant', False)
+                ):
+                    has_matches = True
+            
+            if has_matches:
+                logger.debug("BREF document '%s' has matches or children with matches for pollutant '%s'", bref_type, pollutant)
+        
+        else:
+            pollutant_content = bref_content
+        
+        pollutant_hierarchy[bref_type] = pollutant_content
+    
+    # Validate the hierarchy (debug only: the flags are consistent by construction)
+    all_valid = True
+    if DEBUG_VALIDATE:
+        for bref_type, bref_content in pollutant_hierarchy.items():
+            if isinstance(bref_content, dict):
+                if not validate_hierarchy_matches(bref_content, bref_type):
+                    all_valid = False
+            elif isinstance(bref_content, list):
+                for i, item in enumerate(bref_content):
+                    if not validate_hierarchy_matches(item, f"{bref_type}/[{i}]"):
+                        all_valid = False
+    
+    # Save the pollutant-specific BREF hierarchy
+    save_json(pollutant_hierarchy, output_path)
+    
+    return {
+        'matches': stats['matches'],
+        'parents': stats['parents'],
+        'top_level_matches': top_level_match_count,
+        'top_level_total': len(pollutant_hierarchy),
+        'valid': all_valid,
+    }
 
 def process_bref_pollutant_matches():
     """
@@ -25,39 +286,35 @@ def process_bref_pollutant_matches():
     
     try:
         # Load existing BREF hierarchy
-        with open(bref_hierarchy_path, 'r') as f:
-            bref_data = json.load(f)
+        bref_data = load_json(bref_hierarchy_path)
         
         bref_hierarchy = bref_data.get('hierarchy', {})
         bref_flatmap = bref_data.get('flatMap', {})
         
         # Load pollutant filenames for mapping
-        with open(pollutant_filenames_path, 'r') as f:
-            pollutant_filenames = json.load(f)
+        pollutant_filenames = load_json(pollutant_filenames_path)
         
-        # Load BREF-pollutant match data
-        bref_pollutant_df = pd.read_csv(bref_pollutant_path)
+        # Load BREF-pollutant match data (only the columns we need)
+        bref_pollutant_df = pd.read_csv(
+            bref_pollutant_path,
+            usecols=['code', 'pollutant', 'label'],
+            dtype={'code': 'string', 'pollutant': 'string', 'label': 'int8'},
+        )
         print(f"Loaded {len(bref_pollutant_df)} BREF-pollutant mappings")
         
-        # Create dictionary to store matches for each pollutant
-        pollutant_bref_matches = {}
-        pollutant_match_counts = {}
+        # Create dictionary to store matches for each pollutant, seeded with every
+        # pollutant in the file (in order of appearance) so pollutants without
+        # matches still get their own hierarchy
+        pollutants = bref_pollutant_df['pollutant'].dropna().unique()
+        pollutant_bref_matches = {pollutant: set() for pollutant in pollutants}
+        pollutant_match_counts = {pollutant: 0 for pollutant in pollutants}
         
-        # Process each row in the CSV
-        for _, row in bref_pollutant_df.iterrows():
-            bref_code = row['code']
-            pollutant = row['pollutant']
-            has_match = int(row['label']) == 1  # Ensure it's an integer comparison
-            
-            # Initialize pollutant in dictionaries if not present
-            if pollutant not in pollutant_bref_matches:
-                pollutant_bref_matches[pollutant] = set()
-                pollutant_match_counts[pollutant] = 0
-            
-            # Add to matches if there is a match
-            if has_match:
-                pollutant_bref_matches[pollutant].add(bref_code)
-                pollutant_match_counts[pollutant] += 1
+        # Group the matching rows by pollutant
+        matched_df = bref_pollutant_df[bref_pollutant_df['label'] == 1].dropna(subset=['code', 'pollutant'])
+        matched_groups = matched_df.groupby('pollutant', sort=False)['code']
+        for pollutant, codes in matched_groups:
+            pollutant_bref_matches[pollutant] = set(codes)
+        pollutant_match_counts.update(matched_groups.size().to_dict())
         
         print(f"Processed match data for {len(pollutant_bref_matches)} pollutants")
         
@@ -65,195 +322,97 @@ def process_bref_pollutant_matches():
         for pollutant, count in sorted(pollutant_match_counts.items(), key=lambda x: x[1], reverse=True)[:10]:
             print(f"  Pollutant '{pollutant}' has {count} matching BREF sections")
         
-        # Create a function to update the BREF hierarchy nodes recursively
-        def update_hierarchy_with_matches(node, matches, path=""):
-            """Recursively update the hierarchy to mark nodes with matches"""
-            # Skip non-node items
-            if not node or not isinstance(node, dict):
-                return False
-            
-            node_id = node.get('id')
-            current_path = f"{path}/{node_id}" if node_id else path
-            has_match = False
-            
-            # Check if this node has a direct match
-            if node_id and node_id in matches:
-                # IMPORTANT: Set the flag directly on the node without any nesting
-                node['hasMatchForPollutant'] = True
-                has_match = True
-                print(f"  MATCH: {current_path}")
-            else:
-                # Explicitly set to false (for clarity)
-                node['hasMatchForPollutant'] = False
-            
-            # Process children nodes
-            children_with_matches = False
-            
-            if 'children' in node:
-                if isinstance(node['children'], list):
-                    # Handle list of children
-                    for child in node['children']:
-                        if update_hierarchy_with_matches(child, matches, current_path):
-                            children_with_matches = True
-                
-                elif isinstance(node['children'], dict):
-                    # Handle dictionary of children
-                    for _, child in node['children'].items():
-                        if update_hierarchy_with_matches(child, matches, current_path):
-                            children_with_matches = True
-            
-            # Mark node if any children have matches
-            if children_with_matches:
-                # IMPORTANT: Set the flag directly on the node
-                node['hasChildrenWithMatchForPollutant'] = True
-                has_match = True
-                if not node['hasMatchForPollutant']:
-                    print(f"  PARENT WITH MATCHING CHILDREN: {current_path}")
-            else:
-                # Explicitly set to false (for clarity)
-                node['hasChildrenWithMatchForPollutant'] = False
-            
-            return has_match
-        
-        # Validate that match flags are properly set in the hierarchy
-        def validate_hierarchy_matches(node, path=""):
-            """Validate that match flags are properly set in the hierarchy."""
-            if not isinstance(node, dict):
-                return True
-            
-            # Check if this node has the match flags
-            has_match_flag = 'hasMatchForPollutant' in node
-            has_children_flag = 'hasChildrenWithMatchForPollutant' in node
-            
-            # Validate that flags exist
-            if not has_match_flag or not has_children_flag:
-                print(f"  WARNING: Missing match flags in node {path}/{node.get('id', 'root')}")
-                return False
-            
-            # Check match status for debugging
-            direct_match = node.get('hasMatchForPollutant', False)
-            children_match = node.get('hasChildrenWithMatchForPollutant', False)
-            
-            # Validate children
-            valid = True
-            if 'children' in node:
-                if isinstance(node['children'], list):
-                    for i, child in enumerate(node['children']):
-                        child_path = f"{path}/{node.get('id', 'root')}/[{i}]"
-                        valid = validate_hierarchy_matches(child, child_path) and valid
-                elif isinstance(node['children'], dict):
-                    for child_key, child in node['children'].items():
-                        child_path = f"{path}/{node.get('id', 'root')}/{child_key}"
-                        valid = validate_hierarchy_matches(child, child_path) and valid
-            
-            return valid
-        
-        # Create a pollutant-specific BREF hierarchy for each pollutant
+        # Assign each pollutant a bit so a single integer can record every pollutant matching a node
+        pollutant_bits = {pollutant: 1 << index for index, pollutant in enumerate(pollutant_bref_matches)}
+        node_id_to_bitmask = defaultdict(int)
         for pollutant, matches in pollutant_bref_matches.items():
+            bit = pollutant_bits[pollutant]
+            for bref_id in matches:
+                node_id_to_bitmask[bref_id] |= bit
+        
+        # Find the output file of each pollutant-specific BREF hierarchy, keyed by output path
+        jobs = {}
+        for pollutant in pollutant_bref_matches:
             # Find the filename-safe version of the pollutant
-            pollutant_filename = None
-            for p_name, p_filename in pollutant_filenames.items():
-                if p_name == pollutant:
-                    pollutant_filename = p_filename
-                    break
+            pollutant_filename = pollutant_filenames.get(pollutant)
             
             if not pollutant_filename:
                 print(f"Warning: No filename mapping found for pollutant '{pollutant}'")
                 # Create a safe filename
                 pollutant_filename = pollutant.lower().replace(' ', '_').replace(',', '').replace('(', '').replace(')', '')
             
-            # Create a deep copy of the hierarchy to avoid modifying the original
-            pollutant_hierarchy = copy.deepcopy(bref_hierarchy)
-            
-            print(f"\nProcessing hierarchy for pollutant: {pollutant}")
-            print(f"This pollutant has {len(matches)} matching BREF sections")
-            
-            # Update the hierarchy with match information
-            match_count = 0
-            top_level_match_count = 0
-            for bref_type, bref_content in pollutant_hierarchy.items():
-                # Initialize document-level match flags
-                if isinstance(bref_content, dict):
-                    # IMPORTANT: Clearly set and log these flags for top-level documents
-                    bref_content['hasMatchForPollutant'] = False
-                    bref_content['hasChildrenWithMatchForPollutant'] = False
-                    
-                    # Update hierarchy recursively
-                    has_match = update_hierarchy_with_matches(bref_content, matches, bref_type)
-                    
-                    # Check if flags were properly updated, directly logging the after-values
-                    print(f"BREF document '{bref_type}' after processing:")
-                    print(f"  Direct match: {bref_content.get('hasMatchForPollutant', False)}")
-                    print(f"  Children with matches: {bref_content.get('hasChildrenWithMatchForPollutant', False)}")
-                    
-                    if has_match:
-                        print(f"BREF document '{bref_type}' has matches or children with matches")
-                        match_count += 1
-                        top_level_match_count += 1
-                
-                elif isinstance(bref_content, list):
-                    has_matches = False
-                    for item in bref_content:
-                        # Explicitly set top-level match flags
-                        if isinstance(item, dict):
-                            item['hasMatchForPollutant'] = False
-                            item['hasChildrenWithMatchForPollutant'] = False
-                            
-                            # Update hierarchy and check if any matches were found
-                            if update_hierarchy_with_matches(item, matches, bref_type):
-                                has_matches = True
-                                match_count += 1
-                    
-                    if has_matches:
-                        print(f"BREF document '{bref_type}' has matches or children with matches")
-            
-            print(f"Found matches in {top_level_match_count} top-level BREF documents (out of {len(pollutant_hierarchy)} total)")
-            
-            # Validate the hierarchy
-            print("Validating hierarchy match flags...")
-            all_valid = True
-            for bref_type, bref_content in pollutant_hierarchy.items():
-                if isinstance(bref_content, dict):
-                    if not validate_hierarchy_matches(bref_content, bref_type):
-                        all_valid = False
-                elif isinstance(bref_content, list):
-                    for i, item in enumerate(bref_content):
-                        if not validate_hierarchy_matches(item, f"{bref_type}/[{i}]"):
-                            all_valid = False
+            output_path = os.path.join(pollutant_bref_dir, f"{pollutant_filename}_bref_hierarchy.json")
             
-            if all_valid:
-                print("All match flags are properly set")
-            else:
-                print("WARNING: Some match flags may be missing!")
+            # Two pollutants writing the same file would race in the pool; keep the last
+            # one, as the file would have been overwritten by it when written in order
+            if output_path in jobs:
+                print(f"Warning: Pollutants '{jobs[output_path][0]}' and '{pollutant}' share the output file "
+                      f"{output_path}; only '{pollutant}' will be saved")
+                del jobs[output_path]
             
-            # Save the pollutant-specific BREF hierarchy
-            output_path = os.path.join(pollutant_bref_dir, f"{pollutant_filename}_bref_hierarchy.json")
-            with open(output_path, 'w') as f:
-                json.dump(pollutant_hierarchy, f)
+            jobs[output_path] = (pollutant, pollutant_bits[pollutant], pollutant_filename)
+        
+        # The pollutant-specific hierarchies are independent, so build and save them in
+        # parallel. The hierarchy is sent pre-serialized so each worker parses it only once.
+        if orjson is not None:
+            serialized_hierarchy = orjson.dumps(bref_hierarchy)
+        else:
+            serialized_hierarchy = json.dumps(bref_hierarchy)
+        initargs = (serialized_hierarchy, dict(node_id_to_bitmask))
+        
+        # Every worker parses the whole hierarchy, so never start more workers than there are jobs
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+        summaries = []
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=initargs) as executor:
+                futures = [
+                    executor.submit(process_one, pollutant, bit, output_path)
+                    for output_path, (pollutant, bit, _) in jobs.items()
+                ]
+                summaries = [future.result() for future in futures]
+        elif jobs:
+            # A pool is not worth starting for a single job (or a single core)
+            init_worker(*initargs)
+            summaries = [
+                process_one(pollutant, bit, output_path)
+                for output_path, (pollutant, bit, _) in jobs.items()
+            ]
+            _worker_state.clear()
+        
+        for (pollutant, _, pollutant_filename), summary in zip(jobs.values(), summaries):
+            print(f"\nProcessed hierarchy for pollutant: {pollutant}")
+            print(f"This pollutant has {len(pollutant_bref_matches[pollutant])} matching BREF sections")
+            print(f"Marked {summary['matches']} matching sections and {summary['parents']} parents with matching children")
+            print(f"Found matches in {summary['top_level_matches']} top-level BREF documents (out of {summary['top_level_total']} total)")
+            if DEBUG_VALIDATE:
+                if summary['valid']:
+                    print("All match flags are consistent")
+                else:
+                    print("WARNING: Some match flags are inconsistent!")
             print(f"Saved BREF hierarchy with match info for {pollutant_filename}")
         
-        # Also update the main flatmap with match information for all pollutants
-        for bref_id, bref_node in bref_flatmap.items():
-            matching_pollutants = []
-            for pollutant, matches in pollutant_bref_matches.items():
-                if bref_id in matches:
-                    matching_pollutants.append(pollutant)
-            
-            if matching_pollutants:
-                bref_node['matchingPollutants'] = matching_pollutants
+        # Also update the main flatmap with match information for all pollutants.
+        # Invert the match sets in one pass so only actual matches are visited,
+        # instead of testing every (BREF, pollutant) pair.
+        bref_to_pollutants = defaultdict(list)
+        for pollutant, matches in pollutant_bref_matches.items():
+            for bref_id in matches:
+                bref_to_pollutants[bref_id].append(pollutant)
+        
+        for bref_id, matching_pollutants in bref_to_pollutants.items():
+            if bref_id in bref_flatmap:
+                bref_flatmap[bref_id]['matchingPollutants'] = matching_pollutants
         
         # Update and save the main BREF data with enhanced flatmap
         bref_data['flatMap'] = bref_flatmap
-        with open(bref_hierarchy_path, 'w') as f:
-            json.dump(bref_data, f)
+        save_json(bref_data, bref_hierarchy_path)
         
         print(f"Updated and saved main BREF hierarchy with match information")
         
         # Create a lookup file for quick checking of which BREFs match each pollutant
-        pollutant_bref_lookup = {p: list(m) for p, m in pollutant_bref_matches.items()}
+        # (the match sets are written as lists directly, without building a list-valued copy)
         lookup_path = os.path.join(output_dir, "pollutant_bref_lookup.json")
-        with open(lookup_path, 'w') as f:
-            json.dump(pollutant_bref_lookup, f)
+        save_json(pollutant_bref_matches, lookup_path, default=list)
         print(f"Saved pollutant-BREF lookup table")
         
         return True
@@ -265,4 +424,5 @@ def process_bref_pollutant_matches():
         return False
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
     process_bref_pollutant_matches()
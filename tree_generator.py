@@ -1,28 +1,36 @@
 import os
+import sys
 
 MAX_FILES_PER_DIR = 2  # You can change this
 BASE_PATH = '.'        # Start from current directory
 
-def print_tree(path, prefix=''):
+def print_tree(path, prefix='', lines=None):
+    if lines is None:
+        lines = []
+
     try:
-        entries = sorted(os.listdir(path))
+        # DirEntry objects cache their type, so nothing is stat'ed twice
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda e: e.name)
     except PermissionError:
-        print(f"{prefix}└── [Permission Denied]")
-        return
+        lines.append(f"{prefix}└── [Permission Denied]")
+        return lines
 
-    dirs = [e for e in entries if os.path.isdir(os.path.join(path, e))]
-    files = [e for e in entries if os.path.isfile(os.path.join(path, e))]
+    dirs = [e for e in entries if e.is_dir()]
+    files = [e for e in entries if e.is_file()]
 
     total_entries = len(dirs) + min(len(files), MAX_FILES_PER_DIR)
     for idx, entry in enumerate(dirs + files[:MAX_FILES_PER_DIR]):
         is_last = idx == total_entries - 1
         connector = "└── " if is_last else "├── "
-        print(f"{prefix}{connector}{entry}")
-        full_path = os.path.join(path, entry)
-        if os.path.isdir(full_path):
+        lines.append(f"{prefix}{connector}{entry.name}")
+        if entry.is_dir():
             new_prefix = prefix + ("    " if is_last else "│   ")
-            print_tree(full_path, new_prefix)
+            print_tree(entry.path, new_prefix, lines)
+    return lines
 
-print(BASE_PATH)
-print_tree(BASE_PATH)
+# Collect every line first and write them out in one go
+lines = [BASE_PATH]
+print_tree(BASE_PATH, '', lines)
+sys.stdout.write("\n".join(lines) + "\n")
 